@@ -175,24 +175,21 @@ def create_partition_tables(conn: Connection, config: Configuration) -> None:
 def truncate_data_tables(conn: Connection) -> None:
     """ Truncate all data tables to prepare for a fresh load.
     """
-    with conn.cursor() as cur:
-        cur.execute('TRUNCATE placex')
-        cur.execute('TRUNCATE place_addressline')
-        cur.execute('TRUNCATE location_area')
-        cur.execute('TRUNCATE location_area_country')
-        cur.execute('TRUNCATE location_property_tiger')
-        cur.execute('TRUNCATE location_property_osmline')
-        cur.execute('TRUNCATE location_postcode')
-        if conn.table_exists('search_name'):
-            cur.execute('TRUNCATE search_name')
-        cur.execute('DROP SEQUENCE IF EXISTS seq_place')
-        cur.execute('CREATE SEQUENCE seq_place start 100000')
+    tables = ['placex', 'place_addressline', 'location_area',
+              'location_area_country', 'location_property_tiger',
+              'location_property_osmline', 'location_postcode']
+    if conn.table_exists('search_name'):
+        tables.append('search_name')
 
+    with conn.cursor() as cur:
         cur.execute("""SELECT tablename FROM pg_tables
                        WHERE tablename LIKE 'location_road_%'""")
+        tables.extend(r[0] for r in cur)
 
-        for table in [r[0] for r in list(cur)]:
-            cur.execute('TRUNCATE ' + table)
+        cur.execute('TRUNCATE ' + ', '.join(tables))
+
+        cur.execute('DROP SEQUENCE IF EXISTS seq_place')
+        cur.execute('CREATE SEQUENCE seq_place start 100000')
 
     conn.commit()
 
@@ -17,10 +17,12 @@ userconfig = {
     'BUILDDIR' : (TEST_BASE_DIR / '..' / 'build').resolve(),
     'REMOVE_TEMPLATE' : False,
     'KEEP_TEST_DB' : False,
+    'TRUNCATE_TEST_DB' : False,
     'DB_HOST' : None,
     'DB_PORT' : None,
     'DB_USER' : None,
     'DB_PASS' : None,
+    'DB_TMPFS' : False,
     'TEMPLATE_DB' : 'test_template_nominatim',
     'TEST_DB' : 'test_nominatim',
     'API_TEST_DB' : 'test_api_nominatim',
@@ -45,6 +47,10 @@ def before_all(context):
     context.osm = GeometryFactory()
 
 
+def after_all(context):
+    context.nominatim.teardown_all()
+
+
 def before_scenario(context, scenario):
     if not 'SQLITE' in context.tags \
        and context.config.userdata['API_TEST_DB'].startswith('sqlite:'):
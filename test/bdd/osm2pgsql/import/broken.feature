@@ -1,4 +1,4 @@
-@DB
+@DB @schema-mutating
 Feature: Import of objects with broken geometries by osm2pgsql
 
     Scenario: Import way with double nodes
@@ -1,4 +1,4 @@
-@DB
+@DB @schema-mutating
 Feature: Import with custom styles by osm2pgsql
     Tests for the example customizations given in the documentation.
 
@@ -1,4 +1,4 @@
-@DB
+@DB @schema-mutating
 Feature: Import of relations by osm2pgsql
     Testing specific relation problems related to members.
 
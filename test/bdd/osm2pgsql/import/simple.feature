@@ -1,4 +1,4 @@
-@DB
+@DB @schema-mutating
 Feature: Import of simple objects by osm2pgsql
     Testing basic tagging in osm2pgsql imports.
 
@@ -1,4 +1,4 @@
-@DB
+@DB @schema-mutating
 Feature: Tag evaluation
     Tests if tags are correctly imported into the place table
 
@@ -1,4 +1,4 @@
-@DB
+@DB @schema-mutating
 Feature: Updates of address interpolation objects
     Test that changes to address interpolation objects are correctly
     propagated.
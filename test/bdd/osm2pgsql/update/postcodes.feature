@@ -1,4 +1,4 @@
-@DB
+@DB @schema-mutating
 Feature: Update of postcode only objects
     Tests that changes to objects containing only a postcode are
     propagated correctly.
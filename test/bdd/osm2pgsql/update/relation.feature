@@ -1,4 +1,4 @@
-@DB
+@DB @schema-mutating
 Feature: Update of relations by osm2pgsql
     Testing relation update by osm2pgsql.
 
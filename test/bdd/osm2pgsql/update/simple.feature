@@ -1,4 +1,4 @@
-@DB
+@DB @schema-mutating
 Feature: Update of simple objects by osm2pgsql
     Testing basic update functions of osm2pgsql.
 
@@ -1,4 +1,4 @@
-@DB
+@DB @schema-mutating
 Feature: Tag evaluation
     Tests if tags are correctly updated in the place table
 
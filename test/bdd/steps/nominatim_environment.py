@@ -5,35 +5,106 @@
 # Copyright (C) 2022 by the Nominatim developer community.
 # For a full list of authors see the git log.
 from pathlib import Path
+import atexit
+import contextlib
+import fcntl
+import hashlib
 import importlib
+import os
+import shutil
+import subprocess
 import sys
 import tempfile
 
 import psycopg2
 import psycopg2.extras
 
-sys.path.insert(1, str((Path(__file__) / '..' / '..' / '..' / '..').resolve()))
+_SRC_DIR = (Path(__file__) / '..' / '..' / '..' / '..').resolve()
+
+sys.path.insert(1, str(_SRC_DIR))
 
 from nominatim import cli
 from nominatim.config import Configuration
 from nominatim.db.connection import Connection
 from nominatim.tools import refresh
 from nominatim.tokenizer import factory as tokenizer_factory
+from nominatim.version import NOMINATIM_VERSION
 from steps.utils import run_script
 
+# Session settings for databases that only need to survive the test run.
+_NO_SYNC_OPTIONS = '-c synchronous_commit=off'
+
+# Bookkeeping for restoring tables with template content in a reused
+# test database (see NominatimEnvironment._get_reset_sql()).
+_SNAPSHOT_SETUP_SQL = """
+    CREATE SCHEMA test_template;
+    CREATE TABLE test_template.changed_tables (name TEXT PRIMARY KEY);
+    CREATE FUNCTION test_template.mark_changed() RETURNS TRIGGER AS $$
+    BEGIN
+      INSERT INTO test_template.changed_tables VALUES (TG_TABLE_NAME)
+        ON CONFLICT DO NOTHING;
+      RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql"""
+
+_SNAPSHOT_TRIGGER_SQL = """
+    CREATE TRIGGER test_template_changed
+      AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON public."{}"
+      FOR EACH STATEMENT EXECUTE PROCEDURE test_template.mark_changed()"""
+
+_SNAPSHOT_RESTORE_SQL = """
+    DO $$
+    DECLARE
+      tbl TEXT;
+    BEGIN
+      FOR tbl IN
+        SELECT s.tablename FROM pg_tables s
+         WHERE s.schemaname = 'test_template' and s.tablename != 'changed_tables'
+               and (s.tablename IN (SELECT name FROM test_template.changed_tables)
+                    or NOT EXISTS (SELECT * FROM pg_trigger
+                                    WHERE tgname = 'test_template_changed'
+                                          and tgrelid = to_regclass(format('public.%I',
+                                                                           s.tablename))))
+      LOOP
+        EXECUTE format('TRUNCATE TABLE public.%I', tbl);
+        EXECUTE format('INSERT INTO public.%I SELECT * FROM test_template.%I', tbl, tbl);
+        EXECUTE format('DROP TRIGGER IF EXISTS test_template_changed ON public.%I', tbl);
+        EXECUTE format('CREATE TRIGGER test_template_changed
+                          AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON public.%I
+                          FOR EACH STATEMENT EXECUTE PROCEDURE test_template.mark_changed()',
+                       tbl);
+      END LOOP;
+      TRUNCATE test_template.changed_tables;
+    END;
+    $$"""
+
 class NominatimEnvironment:
     """ Collects all functions for the execution of Nominatim functions.
     """
 
     def __init__(self, config):
         self.build_dir = Path(config['BUILDDIR']).resolve()
-        self.src_dir = (Path(__file__) / '..' / '..' / '..' / '..').resolve()
+        self.src_dir = _SRC_DIR
         self.db_host = config['DB_HOST']
         self.db_port = config['DB_PORT']
         self.db_user = config['DB_USER']
         self.db_pass = config['DB_PASS']
+        self._update_db_params()
+        self.use_tmpfs_cluster = config['DB_TMPFS']
+        self.tmpfs_cluster = None
         self.template_db = config['TEMPLATE_DB']
         self.test_db = config['TEST_DB']
+        # Parallel test processes share the template and API database
+        # but each needs its own scenario database.
+        self.worker_id = os.environ.get('PYTEST_XDIST_WORKER')
+        if self.worker_id:
+            self.test_db += '_' + self.worker_id
+            self.run_id = os.environ.get('PYTEST_XDIST_TESTRUNUID')
+            if not self.run_id:
+                raise RuntimeError("PYTEST_XDIST_TESTRUNUID must be set to an ID "
+                                   "for the test run when PYTEST_XDIST_WORKER is used.")
+        else:
+            self.run_id = None
         self.api_test_db = config['API_TEST_DB']
         self.api_test_file = config['API_TEST_FILE']
         self.tokenizer = config['TOKENIZER']
@@ -41,14 +112,36 @@ class NominatimEnvironment:
         self.server_module_path = config['SERVER_MODULE_PATH']
         self.reuse_template = not config['REMOVE_TEMPLATE']
         self.keep_scenario_db = config['KEEP_TEST_DB']
+        self.truncate_test_db = config['TRUNCATE_TEST_DB']
         self.code_coverage_path = config['PHPCOV']
+        self.code_coverage_dir = Path(self.code_coverage_path).resolve() \
+                                 if self.code_coverage_path else None
         self.code_coverage_id = 1
+        self.php_cgi_bin = shutil.which('php-cgi') or 'php-cgi'
 
         self.default_config = Configuration(None).get_os_env()
+        self.osm2pgsql_path = self.build_dir / 'osm2pgsql' / 'osm2pgsql'
+        self.dir_config = {
+            'NOMINATIM_DATADIR': str(self.src_dir / 'data'),
+            'NOMINATIM_SQLDIR': str(self.src_dir / 'lib-sql'),
+            'NOMINATIM_CONFIGDIR': str(self.src_dir / 'settings'),
+            'NOMINATIM_DATABASE_MODULE_SRC_PATH': str(self.build_dir / 'module'),
+            'NOMINATIM_OSM2PGSQL_BINARY': str(self.osm2pgsql_path)
+        }
+        if self.server_module_path:
+            self.dir_config['NOMINATIM_DATABASE_MODULE_PATH'] = self.server_module_path
+        else:
+            # avoid module being copied into the temporary environment
+            self.dir_config['NOMINATIM_DATABASE_MODULE_PATH'] = str(self.build_dir / 'module')
         self.test_env = None
+        self.pg_options = None
         self.template_db_done = False
         self.api_db_done = False
+        self.test_db_reset_sql = None
+        self.hstore_oids = None
+        self.maintenance_conn = None
         self.website_dir = None
+        self.website_dir_cache = {}
 
         self.api_engine = None
         if config['API_ENGINE'] != 'php':
@@ -56,88 +149,182 @@ class NominatimEnvironment:
                 raise RuntimeError(f"Unknown API engine '{config['API_ENGINE']}'")
             self.api_engine = getattr(self, f"create_api_request_func_{config['API_ENGINE']}")()
 
+    def _update_db_params(self):
+        """ Collect the connection parameters for the database server
+            that are shared by all test databases.
+        """
+        self.db_params = {key: value for key, value in (('host', self.db_host),
+                                                        ('port', self.db_port),
+                                                        ('user', self.db_user),
+                                                        ('password', self.db_pass))
+                          if value}
+
     def connect_database(self, dbname):
         """ Return a connection to the database with the given name.
             Uses configured host, user and port.
         """
-        dbargs = {'database': dbname}
-        if self.db_host:
-            dbargs['host'] = self.db_host
-        if self.db_port:
-            dbargs['port'] = self.db_port
-        if self.db_user:
-            dbargs['user'] = self.db_user
-        if self.db_pass:
-            dbargs['password'] = self.db_pass
+        dbargs = dict(self.db_params, dbname=dbname)
+        if dbname in (self.template_db, self.test_db):
+            dbargs['options'] = _NO_SYNC_OPTIONS
         conn = psycopg2.connect(connection_factory=Connection, **dbargs)
         return conn
 
+    def maintenance_connection(self):
+        """ Return a connection to the 'postgres' database in autocommit
+            mode. It is used for creating and dropping databases. The
+            connection is opened once and then kept for the lifetime of the
+            environment. Connections to the template and test databases
+            cannot be kept around in the same way because they would
+            block copying and dropping of these databases.
+        """
+        if self.maintenance_conn is None or self.maintenance_conn.closed:
+            self.maintenance_conn = self.connect_database('postgres')
+            self.maintenance_conn.autocommit = True
+
+        return self.maintenance_conn
+
     def next_code_coverage_file(self):
-        """ Generate the next name for a coverage file.
+        """ Generate the next name for a coverage file. The name includes
+            the process ID, so that coverage files from parallel or repeated
+            runs into the same directory do not overwrite each other.
         """
-        fn = Path(self.code_coverage_path) / "{:06d}.cov".format(self.code_coverage_id)
+        fn = self.code_coverage_dir / "{:06d}-{:06d}.cov".format(os.getpid(),
+                                                                 self.code_coverage_id)
         self.code_coverage_id += 1
 
-        return fn.resolve()
+        return fn
+
+    def _ensure_tmpfs_cluster(self):
+        """ Create and start a throw-away database cluster in shared memory
+            when requested by the configuration. The cluster runs with all
+            durability settings switched off and the connection parameters
+            are redirected to it for the remainder of the test run.
+        """
+        if not self.use_tmpfs_cluster or self.tmpfs_cluster is not None:
+            return
 
-    def write_nominatim_config(self, dbname):
+        bindir = Path(run_script(['pg_config', '--bindir'])[0].strip())
+        self.tmpfs_cluster = Path(tempfile.mkdtemp(dir='/dev/shm',
+                                                   prefix='nominatim-test-pg-'))
+
+        initdb = [str(bindir / 'initdb'), '-D', str(self.tmpfs_cluster),
+                  '--no-sync', '--auth', 'trust']
+        if self.db_user:
+            initdb.extend(('--username', self.db_user))
+        run_script(initdb)
+
+        options = ' '.join(('-c fsync=off', '-c synchronous_commit=off',
+                            '-c full_page_writes=off', '-c wal_level=minimal',
+                            '-c max_wal_senders=0', "-c listen_addresses=''",
+                            '-k', str(self.tmpfs_cluster)))
+        run_script([str(bindir / 'pg_ctl'), 'start', '-w', '-D', str(self.tmpfs_cluster),
+                    '-l', str(self.tmpfs_cluster / 'server.log'), '-o', options])
+
+        def _stop_cluster(cluster):
+            subprocess.run([str(bindir / 'pg_ctl'), 'stop', '-m', 'immediate',
+                            '-D', str(cluster)],
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                           check=False)
+            shutil.rmtree(str(cluster), ignore_errors=True)
+
+        atexit.register(_stop_cluster, self.tmpfs_cluster)
+
+        self.db_host = str(self.tmpfs_cluster)
+        self.db_port = None
+        self.db_pass = None
+        self._update_db_params()
+
+        with self.maintenance_connection().cursor() as cur:
+            cur.execute('CREATE ROLE "{}"'.format(
+                            self.default_config['NOMINATIM_DATABASE_WEBUSER']))
+
+
+    def _template_fingerprint(self):
+        """ Compute a fingerprint for the configuration the template
+            database is built with. It covers the tokenizer, the import
+            style, the source revision and the version of the database
+            server. A reused template is only valid when its fingerprint
+            matches.
+        """
+        try:
+            proc = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=str(self.src_dir),
+                                  stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                  check=False)
+        except OSError:
+            proc = None
+        if proc is not None and proc.returncode == 0:
+            revision = proc.stdout.decode('utf-8').strip()
+        else:
+            revision = str(NOMINATIM_VERSION)
+
+        server_version = self.maintenance_connection().server_version
+
+        parts = (self.tokenizer, self.import_style, revision, server_version)
+
+        return hashlib.sha256(repr(parts).encode('utf-8')).hexdigest()
+
+
+    def write_nominatim_config(self, dbname, connect=True):
         """ Set up a custom test configuration that connects to the given
             database. This sets up the environment variables so that they can
             be picked up by dotenv and creates a project directory with the
-            appropriate website scripts.
+            appropriate website scripts. When 'connect' is False, the website
+            scripts are created without looking at the database.
+
+            The API test database is never changed by the tests, so its
+            project directory is created only once and then reused.
         """
         if dbname.startswith('sqlite:'):
             dsn = 'sqlite:dbname={}'.format(dbname[7:])
         else:
             dsn = 'pgsql:dbname={}'.format(dbname)
-        if self.db_host:
-            dsn += ';host=' + self.db_host
-        if self.db_port:
-            dsn += ';port=' + self.db_port
-        if self.db_user:
-            dsn += ';user=' + self.db_user
-        if self.db_pass:
-            dsn += ';password=' + self.db_pass
+        dsn = ';'.join([dsn] + ['{}={}'.format(*p) for p in self.db_params.items()])
+
+        if self.website_dir is not None \
+           and self.website_dir not in (c[0] for c in self.website_dir_cache.values()):
+            self.website_dir.cleanup()
+
+        if dsn in self.website_dir_cache:
+            self.website_dir, test_env = self.website_dir_cache[dsn]
+            self.test_env = dict(test_env)
+            self.pg_options = None
+            return
 
         self.test_env = dict(self.default_config)
         self.test_env['NOMINATIM_DATABASE_DSN'] = dsn
+        if dbname in (self.template_db, self.test_db):
+            self.pg_options = _NO_SYNC_OPTIONS
+        else:
+            self.pg_options = None
         self.test_env['NOMINATIM_LANGUAGES'] = 'en,de,fr,ja'
         self.test_env['NOMINATIM_FLATNODE_FILE'] = ''
         self.test_env['NOMINATIM_IMPORT_STYLE'] = 'full'
         self.test_env['NOMINATIM_USE_US_TIGER_DATA'] = 'yes'
-        self.test_env['NOMINATIM_DATADIR'] = str((self.src_dir / 'data').resolve())
-        self.test_env['NOMINATIM_SQLDIR'] = str((self.src_dir / 'lib-sql').resolve())
-        self.test_env['NOMINATIM_CONFIGDIR'] = str((self.src_dir / 'settings').resolve())
-        self.test_env['NOMINATIM_DATABASE_MODULE_SRC_PATH'] = str((self.build_dir / 'module').resolve())
-        self.test_env['NOMINATIM_OSM2PGSQL_BINARY'] = str((self.build_dir / 'osm2pgsql' / 'osm2pgsql').resolve())
+        self.test_env.update(self.dir_config)
         if self.tokenizer is not None:
             self.test_env['NOMINATIM_TOKENIZER'] = self.tokenizer
         if self.import_style is not None:
             self.test_env['NOMINATIM_IMPORT_STYLE'] = self.import_style
 
-        if self.server_module_path:
-            self.test_env['NOMINATIM_DATABASE_MODULE_PATH'] = self.server_module_path
-        else:
-            # avoid module being copied into the temporary environment
-            self.test_env['NOMINATIM_DATABASE_MODULE_PATH'] = str((self.build_dir / 'module').resolve())
-
-        if self.website_dir is not None:
-            self.website_dir.cleanup()
-
         self.website_dir = tempfile.TemporaryDirectory()
 
         try:
-            conn = self.connect_database(dbname)
+            conn = self.connect_database(dbname) if connect else False
         except:
             conn = False
         refresh.setup_website(Path(self.website_dir.name) / 'website',
                               self.get_test_config(), conn)
+        if conn:
+            conn.close()
+
+        if dbname == self.api_test_db:
+            self.website_dir_cache[dsn] = (self.website_dir, dict(self.test_env))
 
 
     def get_test_config(self):
         cfg = Configuration(Path(self.website_dir.name), environ=self.test_env)
         cfg.set_libdirs(module=self.build_dir / 'module',
-                        osm2pgsql=self.build_dir / 'osm2pgsql' / 'osm2pgsql')
+                        osm2pgsql=self.osm2pgsql_path)
         return cfg
 
     def get_libpq_dsn(self):
@@ -158,13 +345,16 @@ class NominatimEnvironment:
 
 
     def db_drop_database(self, name):
-        """ Drop the database with the given name.
+        """ Drop the database with the given name. On PostgreSQL 13 and
+            later, connections that are still open on the database are
+            terminated.
         """
-        conn = self.connect_database('postgres')
-        conn.set_isolation_level(0)
-        cur = conn.cursor()
-        cur.execute('DROP DATABASE IF EXISTS {}'.format(name))
-        conn.close()
+        conn = self.maintenance_connection()
+        with conn.cursor() as cur:
+            if conn.server_version >= 130000:
+                cur.execute('DROP DATABASE IF EXISTS {} WITH (FORCE)'.format(name))
+            else:
+                cur.execute('DROP DATABASE IF EXISTS {}'.format(name))
 
     def setup_template_db(self):
         """ Setup a template database that already contains common test data.
@@ -176,56 +366,78 @@ class NominatimEnvironment:
 
         self.template_db_done = True
 
-        self.write_nominatim_config(self.template_db)
+        self._ensure_tmpfs_cluster()
+        fingerprint = self._template_fingerprint()
+
+        with self._setup_lock(self.template_db, fingerprint) as done_by_other_worker:
+            # Other workers may already be copying the template, so
+            # it must not be connected to when it is ready.
+            self.write_nominatim_config(self.template_db, connect=not done_by_other_worker)
+            if done_by_other_worker:
+                return
 
-        if not self._reuse_or_drop_db(self.template_db):
-            try:
-                # execute nominatim import on an empty file to get the right tables
-                with tempfile.NamedTemporaryFile(dir='/tmp', suffix='.xml') as fd:
-                    fd.write(b'<osm version="0.6"></osm>')
-                    fd.flush()
-                    self.run_nominatim('import', '--osm-file', fd.name,
+            if not self._reuse_or_drop_db(self.template_db, fingerprint):
+                try:
+                    # execute nominatim import on an empty file to get the right tables
+                    empty_file = self.src_dir / 'test' / 'testdata' / 'empty.osm'
+                    self.run_nominatim('import', '--osm-file', str(empty_file),
                                                  '--osm2pgsql-cache', '1',
                                                  '--ignore-errors',
                                                  '--offline', '--index-noanalyse')
-            except:
-                self.db_drop_database(self.template_db)
-                raise
+                    with contextlib.closing(self.connect_database(self.template_db)) as conn:
+                        conn.autocommit = True
+                        with conn.cursor() as cur:
+                            cur.execute('COMMENT ON DATABASE {} IS %s'.format(self.template_db),
+                                        (fingerprint, ))
+                            # Freeze once, so that the copies start out with
+                            # clean visibility maps and planner statistics.
+                            cur.execute('VACUUM (FREEZE, ANALYZE)')
+                except:
+                    self.db_drop_database(self.template_db)
+                    raise
 
-        self.run_nominatim('refresh', '--functions')
+            # Always needed: the import creates the functions without support
+            # for diff updates, and a reused template may have outdated ones.
+            self.run_nominatim('refresh', '--functions')
 
 
     def setup_api_db(self):
         """ Setup a test against the API test database.
         """
-        self.write_nominatim_config(self.api_test_db)
-
         if self.api_test_db.startswith('sqlite:'):
+            self.write_nominatim_config(self.api_test_db)
             return
 
-        if not self.api_db_done:
+        self._ensure_tmpfs_cluster()
+
+        if self.api_db_done:
+            self.write_nominatim_config(self.api_test_db)
+        else:
             self.api_db_done = True
 
-            if not self._reuse_or_drop_db(self.api_test_db):
-                testdata = (Path(__file__) / '..' / '..' / '..' / 'testdb').resolve()
-                self.test_env['NOMINATIM_WIKIPEDIA_DATA_PATH'] = str(testdata)
-                simp_file = Path(self.website_dir.name) / 'secondary_importance.sql.gz'
-                simp_file.symlink_to(testdata / 'secondary_importance.sql.gz')
-
-                try:
-                    self.run_nominatim('import', '--osm-file', str(self.api_test_file))
-                    self.run_nominatim('add-data', '--tiger-data', str(testdata / 'tiger'))
-                    self.run_nominatim('freeze')
-
-                    if self.tokenizer == 'legacy':
-                        phrase_file = str(testdata / 'specialphrases_testdb.sql')
-                        run_script(['psql', '-d', self.api_test_db, '-f', phrase_file])
-                    else:
-                        csv_path = str(testdata / 'full_en_phrases_test.csv')
-                        self.run_nominatim('special-phrases', '--import-from-csv', csv_path)
-                except:
-                    self.db_drop_database(self.api_test_db)
-                    raise
+            with self._setup_lock(self.api_test_db) as done_by_other_worker:
+                self.write_nominatim_config(self.api_test_db)
+                if not done_by_other_worker \
+                   and not self._reuse_or_drop_db(self.api_test_db):
+                    testdata = self.src_dir / 'test' / 'testdb'
+                    self.test_env['NOMINATIM_WIKIPEDIA_DATA_PATH'] = str(testdata)
+                    simp_file = Path(self.website_dir.name) / 'secondary_importance.sql.gz'
+                    simp_file.symlink_to(testdata / 'secondary_importance.sql.gz')
+
+                    try:
+                        self.run_nominatim('import', '--osm-file', str(self.api_test_file))
+                        self.run_nominatim('add-data', '--tiger-data', str(testdata / 'tiger'))
+                        self.run_nominatim('freeze')
+
+                        if self.tokenizer == 'legacy':
+                            phrase_file = str(testdata / 'specialphrases_testdb.sql')
+                            run_script(['psql', '-d', self.get_libpq_dsn(), '-f', phrase_file])
+                        else:
+                            csv_path = str(testdata / 'full_en_phrases_test.csv')
+                            self.run_nominatim('special-phrases', '--import-from-csv', csv_path)
+                    except:
+                        self.db_drop_database(self.api_test_db)
+                        raise
 
         tokenizer_factory.get_tokenizer_for_db(self.get_test_config())
 
@@ -247,18 +459,38 @@ class NominatimEnvironment:
 
     def setup_db(self, context):
         """ Setup a test against a fresh, empty test database.
+
+            When truncating of the test database is enabled, then the
+            database from the previous scenario is cleaned up instead of
+            being recreated from the template, unless the scenario is
+            tagged as 'schema-mutating'.
         """
         self.setup_template_db()
-        conn = self.connect_database(self.template_db)
-        conn.set_isolation_level(0)
-        cur = conn.cursor()
-        cur.execute('DROP DATABASE IF EXISTS {}'.format(self.test_db))
-        cur.execute('CREATE DATABASE {} TEMPLATE = {}'.format(self.test_db, self.template_db))
-        conn.close()
-        self.write_nominatim_config(self.test_db)
-        context.db = self.connect_database(self.test_db)
-        context.db.autocommit = True
-        psycopg2.extras.register_hstore(context.db, globally=False)
+        if self.test_db_reset_sql is not None \
+           and 'schema-mutating' not in getattr(context, 'tags', ()):
+            self.write_nominatim_config(self.test_db)
+            context.db = self.connect_database(self.test_db)
+            context.db.autocommit = True
+            with context.db.cursor() as cur:
+                cur.execute(self.test_db_reset_sql)
+        else:
+            self.db_drop_database(self.test_db)
+            with self.maintenance_connection().cursor() as cur:
+                cur.execute('CREATE DATABASE {} TEMPLATE = {}'.format(self.test_db,
+                                                                     self.template_db))
+            self.write_nominatim_config(self.test_db)
+            context.db = self.connect_database(self.test_db)
+            context.db.autocommit = True
+            if self.truncate_test_db:
+                self.test_db_reset_sql = self._get_reset_sql(context.db)
+        if self.hstore_oids is None:
+            # All test databases are copies of the template, so the OIDs
+            # only need to be looked up once.
+            with context.db.cursor() as cur:
+                cur.execute("SELECT 'hstore'::regtype::oid, 'hstore[]'::regtype::oid")
+                self.hstore_oids = cur.fetchone()
+        psycopg2.extras.register_hstore(context.db, oid=self.hstore_oids[0],
+                                        array_oid=self.hstore_oids[1])
 
     def teardown_db(self, context, force_drop=False):
         """ Remove the test database, if it exists.
@@ -266,25 +498,124 @@ class NominatimEnvironment:
         if hasattr(context, 'db'):
             context.db.close()
 
+        if self.test_db_reset_sql is not None:
+            if force_drop or 'schema-mutating' in getattr(context, 'tags', ()):
+                self.test_db_reset_sql = None
+            else:
+                return
+
         if force_drop or not self.keep_scenario_db:
             self.db_drop_database(self.test_db)
 
-    def _reuse_or_drop_db(self, name):
+    def teardown_all(self):
+        """ Clean up at the end of the test run. Removes the test database
+            when it was kept for reuse between scenarios and closes the
+            maintenance connection.
+        """
+        if self.test_db_reset_sql is not None and not self.keep_scenario_db:
+            self.db_drop_database(self.test_db)
+            self.test_db_reset_sql = None
+
+        if self.maintenance_conn is not None:
+            self.maintenance_conn.close()
+            self.maintenance_conn = None
+
+    def _get_reset_sql(self, conn):
+        """ Compute the SQL that resets a database freshly created from the
+            template back into its initial state: all tables that are
+            empty in the template are truncated together with the sequences
+            they own. The content of all other tables is saved away in the
+            schema 'test_template'. A statement trigger marks such tables
+            as changed and they are restored when they have been changed
+            or recreated. The word sequence is set back to go with the
+            restored word table.
+        """
+        with conn.cursor() as cur:
+            cur.execute("SELECT tablename FROM pg_tables WHERE schemaname = 'public'")
+            tables = []
+            snapshot_tables = []
+            for table in [r[0] for r in cur.fetchall()]:
+                cur.execute('SELECT EXISTS(SELECT * FROM "{}")'.format(table))
+                if cur.fetchone()[0]:
+                    snapshot_tables.append(table)
+                else:
+                    tables.append('"{}"'.format(table))
+
+            sql = []
+            if tables:
+                sql.append('TRUNCATE TABLE {} RESTART IDENTITY CASCADE'.format(', '.join(tables)))
+
+            cur.execute(_SNAPSHOT_SETUP_SQL)
+            for table in snapshot_tables:
+                cur.execute('CREATE TABLE test_template."{0}" AS SELECT * FROM "{0}"'.format(table))
+                cur.execute(_SNAPSHOT_TRIGGER_SQL.format(table))
+            sql.append(_SNAPSHOT_RESTORE_SQL)
+
+            cur.execute("""SELECT coalesce(last_value, start_value), last_value is not null
+                             FROM pg_sequences
+                            WHERE schemaname = 'public' and sequencename = 'seq_word'""")
+            row = cur.fetchone()
+            if row is not None and 'word' in snapshot_tables:
+                sql.append(cur.mogrify("SELECT setval('seq_word', %s, %s)",
+                                       row).decode('utf-8'))
+
+        return ';'.join(sql)
+
+    @contextlib.contextmanager
+    def _setup_lock(self, name, fingerprint=None):
+        """ Serialize the setup of the shared database with the given name
+            between parallel test processes. Yields True when another
+            process of the same test run has already set up the database
+            with the same fingerprint and the database still exists.
+            Without parallel workers, no lock is needed.
+        """
+        if not self.worker_id:
+            yield False
+            return
+
+        marker = '{} {}'.format(self.run_id, fingerprint or '')
+
+        lockdir = self.tmpfs_cluster or Path(tempfile.gettempdir())
+        with open(str(lockdir / '{}.lock'.format(name)), 'a+') as fd:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            fd.seek(0)
+            if fd.read() == marker and self._db_exists(name):
+                yield True
+                return
+
+            yield False
+
+            fd.seek(0)
+            fd.truncate()
+            fd.write(marker)
+
+    def _db_exists(self, name):
+        """ Check if a database with the given name exists.
+        """
+        with self.maintenance_connection().cursor() as cur:
+            cur.execute('SELECT count(*) FROM pg_database WHERE datname = %s', (name, ))
+            return cur.fetchone()[0] == 1
+
+
+    def _reuse_or_drop_db(self, name, fingerprint=None):
         """ Check for the existance of the given DB. If reuse is enabled,
             then the function checks for existance and returns True if the
-            database is already there. Otherwise an existing database is
-            dropped and always false returned.
+            database is already there. When a fingerprint is given, the
+            database is only reused when its comment matches the fingerprint.
+            Otherwise an existing database is dropped and always false returned.
         """
         if self.reuse_template:
-            conn = self.connect_database('postgres')
-            with conn.cursor() as cur:
-                cur.execute('select count(*) from pg_database where datname = %s',
+            with self.maintenance_connection().cursor() as cur:
+                cur.execute("""SELECT shobj_description(oid, 'pg_database')
+                               FROM pg_database WHERE datname = %s""",
                             (name,))
-                if cur.fetchone()[0] == 1:
-                    return True
-            conn.close()
-        else:
-            self.db_drop_database(name)
+                row = cur.fetchone()
+            if row is None:
+                return False
+            if fingerprint is None or row[0] == fingerprint:
+                return True
+
+        self.db_drop_database(name)
 
         return False
 
@@ -308,10 +639,21 @@ class NominatimEnvironment:
         if self.website_dir is not None:
             cmdline = list(cmdline) + ['--project-dir', self.website_dir.name]
 
-        cli.nominatim(module_dir='',
-                      osm2pgsql_path=str(self.build_dir / 'osm2pgsql' / 'osm2pgsql'),
-                      cli_args=cmdline,
-                      environ=self.test_env)
+        # Connections are opened by the library and by external tools,
+        # so session options can only be handed in through libpq's environment.
+        old_options = os.environ.get('PGOPTIONS')
+        if self.pg_options is not None:
+            os.environ['PGOPTIONS'] = ' '.join(filter(None, (old_options, self.pg_options)))
+        try:
+            cli.nominatim(module_dir='',
+                          osm2pgsql_path=str(self.osm2pgsql_path),
+                          cli_args=cmdline,
+                          environ=self.test_env)
+        finally:
+            if old_options is None:
+                os.environ.pop('PGOPTIONS', None)
+            else:
+                os.environ['PGOPTIONS'] = old_options
 
 
     def copy_from_place(self, db):
@@ -114,7 +114,7 @@ def send_api_query_php(endpoint, params, context):
         for k, v in context.http_headers.items():
             env['HTTP_' + k.upper().replace('-', '_')] = v
 
-    cmd = ['/usr/bin/env', 'php-cgi', '-f']
+    cmd = [context.nominatim.php_cgi_bin, '-f']
     if context.nominatim.code_coverage_path:
         env['XDEBUG_MODE'] = 'coverage'
         env['COV_SCRIPT_FILENAME'] = env['SCRIPT_FILENAME']
@@ -127,8 +127,7 @@ def send_api_query_php(endpoint, params, context):
     else:
         cmd.append(env['SCRIPT_FILENAME'])
 
-    for k,v in params.items():
-        cmd.append(f"{k}={v}")
+    cmd.extend(f"{k}={v}" for k, v in params.items())
 
     outp, err = run_script(cmd, cwd=context.nominatim.website_dir.name, env=env)
 
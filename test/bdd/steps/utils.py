@@ -15,7 +15,12 @@ LOG = logging.getLogger(__name__)
 def run_script(cmd, **kwargs):
     """ Run the given command, check that it is successful and output
         when necessary.
+
+        File descriptors are not closed in the child by default. Python
+        opens all its file descriptors as non-inheritable, so there is
+        nothing to close and scanning the descriptor table can be skipped.
     """
+    kwargs.setdefault('close_fds', False)
     proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
                             **kwargs)
     (outp, outerr) = proc.communicate()